@@ -0,0 +1,182 @@
+import time
+import threading
+from datetime import date, datetime, time as dt_time
+
+import numpy as np
+
+from storage import SIGNATURE_DAY_SQL
+
+
+EPOCH = date(1970, 1, 1)
+
+
+def to_days(dt, timezone):
+    """
+    Converts date/datetime to the number of days since the epoch in a given timezone
+    """
+    if isinstance(dt, datetime):
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone)
+        dt = dt.date()
+
+    return (dt - EPOCH).days
+
+
+def since_to_days(since, timezone):
+    """
+    Converts lower bound of the period to the first whole day that falls into it.
+    Signature dates are stored without time part, so the day is included only
+    if its midnight is not earlier than the bound
+    """
+    if isinstance(since, datetime) and since.tzinfo is not None:
+        since = since.astimezone(timezone)
+
+    days = to_days(since, timezone)
+    if isinstance(since, datetime) and since.time() != dt_time(0, 0):
+        days += 1
+
+    return days
+
+
+class ProcurementsSnapshot:
+    """
+    In-memory columnar copy of procurements table, sorted by (region, product, date).
+    Region and product names are stored as small integer codes, so the rows of each
+    pair form a contiguous slice which is located with the binary search
+    """
+
+    def __init__(self, regions, products, keys, days, price, total_amount, timezone):
+        self.timezone = timezone
+        self.regions = {r: i for i, r in enumerate(regions)}
+        self.products = {p: i for i, p in enumerate(products)}
+        self.keys = keys
+        self.days = days
+        self.price = price
+        self.total_amount = total_amount
+        self.loaded_at = time.time()
+
+    @classmethod
+    def load(cls, db, timezone):
+        region_col, product_col, days, price, total_amount = [], [], [], [], []
+        q = db.query(
+            f"SELECT p.region, p.product_name, {SIGNATURE_DAY_SQL} AS day, p.price, p.total_amount FROM procurements p",
+            tz=timezone.zone,
+        )
+
+        for r in q:
+            # such rows can't match any stats query
+            if r["day"] is None or r["region"] is None or r["product_name"] is None:
+                continue
+
+            region_col.append(r["region"])
+            product_col.append(r["product_name"])
+            days.append(to_days(r["day"], timezone))
+            price.append(np.nan if r["price"] is None else r["price"])
+            total_amount.append(np.nan if r["total_amount"] is None else r["total_amount"])
+
+        regions, region_codes = np.unique(np.array(region_col, dtype=object), return_inverse=True)
+        products, product_codes = np.unique(np.array(product_col, dtype=object), return_inverse=True)
+
+        keys = region_codes.astype(np.int32) * len(products) + product_codes.astype(np.int32)
+        days = np.array(days, dtype=np.int32)
+        order = np.lexsort((days, keys))
+
+        return cls(
+            regions=list(regions),
+            products=list(products),
+            keys=keys[order],
+            days=days[order],
+            price=np.array(price, dtype=np.float64)[order],
+            total_amount=np.array(total_amount, dtype=np.float64)[order],
+            timezone=timezone,
+        )
+
+    def __len__(self):
+        return len(self.days)
+
+    def get_slice(self, region, product_name):
+        if region not in self.regions or product_name not in self.products:
+            return 0, 0
+
+        key = self.regions[region] * len(self.products) + self.products[product_name]
+        return (
+            np.searchsorted(self.keys, key, side="left"),
+            np.searchsorted(self.keys, key, side="right"),
+        )
+
+    def get_product_stats_since(self, region, product_name, since):
+        """
+        Same aggregates as the SQL query: count and sum of total amount and min/avg/max of price
+        """
+        lo, hi = self.get_slice(region, product_name)
+        if lo == hi:
+            return None
+
+        lo += np.searchsorted(self.days[lo:hi], since_to_days(since, self.timezone), side="left")
+
+        total_amount = self.total_amount[lo:hi]
+        count = int(np.count_nonzero(~np.isnan(total_amount)))
+        if count == 0:
+            return None
+
+        price = self.price[lo:hi]
+        if np.isnan(price).all():
+            min_price = avg_price = max_price = None
+        else:
+            min_price = float(np.nanmin(price))
+            avg_price = float(np.nanmean(price))
+            max_price = float(np.nanmax(price))
+
+        return {
+            "count": count,
+            "total": float(np.nansum(total_amount)),
+            "min": min_price,
+            "avg": avg_price,
+            "max": max_price,
+        }
+
+
+class SnapshotHolder:
+    """
+    Keeps the latest snapshot and reloads it once sync_spreadsheet reports
+    a newer sync in the meta table. Meta table is checked at most once per check_interval seconds
+    """
+
+    def __init__(self, db, meta, timezone, check_interval=60):
+        self.db = db
+        self.meta = meta
+        self.timezone = timezone
+        self.check_interval = check_interval
+
+        self._snapshot = None
+        self._synced_at = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def get_last_sync(self):
+        rec = self.meta.find_one(key="last_sync")
+        if rec is not None:
+            return rec["value"]
+
+    def is_stale(self):
+        return self._snapshot is None or time.time() - self._checked_at > self.check_interval
+
+    def refresh(self):
+        with self._lock:
+            # another thread could have reloaded the snapshot while this one was waiting for the lock
+            if self.is_stale():
+                synced_at = self.get_last_sync()
+                if self._snapshot is None or synced_at != self._synced_at:
+                    self._snapshot = ProcurementsSnapshot.load(self.db, self.timezone)
+                    self._synced_at = synced_at
+
+                self._checked_at = time.time()
+
+            return self._snapshot
+
+    def get(self):
+        if self.is_stale():
+            return self.refresh()
+
+        return self._snapshot
+
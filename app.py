@@ -3,9 +3,14 @@ import logging
 import sched
 import threading
 import os
+import csv
+import math
+import multiprocessing
+import socket
 from logging.config import dictConfig
-from datetime import datetime
-from collections import OrderedDict
+from datetime import datetime, timedelta
+from collections import OrderedDict, Counter
+from itertools import groupby
 from uuid import uuid4
 
 from dateutil.parser import parse as dt_parse, ParserError as DateParserError
@@ -14,9 +19,9 @@ from dateutil.relativedelta import relativedelta
 import click
 from tqdm import tqdm
 import gspread
-from flask import Flask, request, Response, url_for, abort, redirect
-from sqlalchemy.sql import and_, func, expression
-from openpyxl import Workbook
+from flask import Flask, request, Response, abort, redirect
+from sqlalchemy.sql import and_, func, expression, text
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 from openpyxl.writer.excel import save_virtual_workbook
@@ -36,10 +41,11 @@ from viberbot.api.messages import TextMessage, ContactMessage, PictureMessage, V
 
 
 from exc import InvalidSheet, InvalidRecord
-from storage import get_postgres_database
+from storage import get_postgres_database, mark_synced, schema_lock, SIGNATURE_DAY_SQL
 from dicts import REGIONS, PRODUCT_CATEGORIES, HEADERS, SUBSCRIPTION_TYPES
 from keyboards import VIBER_MENU_KBD, VIBER_REGIONS_KBD, get_viber_categories_kbd, get_viber_subscribe_kbd
 from utils import parse_amount, parse_int
+from sketches import PriceSketch
 
 
 app = Flask(__name__)
@@ -48,6 +54,9 @@ db = get_postgres_database(app)
 procurements = db["procurements"]
 subscriptions = db["subscriptions"]
 sent_log = db["sent_log"]
+meta = db["meta"]
+price_sketches = db["price_sketches"]
+sync_deltas = db["sync_deltas"]
 dictConfig(app.config["LOGGING"])
 
 viber = Api(
@@ -57,9 +66,21 @@ viber = Api(
         auth_token=app.config["BOT_AUTH_TOKEN"],
     )
 )
+if app.config.get("VIBER_API_URL"):
+    # viberbot has no public setting for that, used to point the bot to a local stand-in for load tests
+    viber._request_sender._viber_bot_api_url = app.config["VIBER_API_URL"]
 
+snapshot = None
+if app.config.get("ANALYTICS_ENGINE", "sql") == "numpy":
+    from analytics import SnapshotHolder
+
+    snapshot = SnapshotHolder(db, meta, app.config["TIMEZONE"], app.config.get("ANALYTICS_REFRESH_INTERVAL", 60))
+
+
+def get_product_stats_since(region, product_name, since, use_sql=False):
+    if snapshot is not None and not use_sql:
+        return snapshot.get().get_product_stats_since(region, product_name, since)
 
-def get_product_stats_since(region, product_name, since):
     ptc = procurements.table.c
 
     q = db.query(
@@ -80,22 +101,137 @@ def get_product_stats_since(region, product_name, since):
             return r
 
 
-def get_product_stats(region, product_name):
-    now = datetime.now(app.config["TIMEZONE"])
+QUANTILES = (0.25, 0.5, 0.75, 0.9)
+
+
+def get_day_bounds(day):
+    tz = app.config["TIMEZONE"]
+    start = tz.localize(datetime.combine(day, datetime.min.time()))
+    return start, tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+
+
+def rebuild_price_sketches(keys):
+    """
+    Recalculates daily price sketches for given (region, product_name, day) keys.
+    Prices for all the keys are streamed by a single query ordered by key
+    and the sketches are replaced in bulk
+    """
+    if not keys:
+        return
+
+    keys = sorted(keys)
+    params = {
+        "regions": [region for region, _, _ in keys],
+        "products": [product_name for _, product_name, _ in keys],
+        "days": [day for _, _, day in keys],
+    }
+    sketches = OrderedDict((key, PriceSketch()) for key in keys)
+
+    rows = db.executable.execution_options(stream_results=True).execute(
+        text(
+            f"""
+            SELECT p.region, p.product_name, {SIGNATURE_DAY_SQL} AS day, p.price
+            FROM procurements p
+            JOIN unnest(:regions, :products, :days) AS k(region, product_name, day)
+            ON p.region = k.region AND p.product_name = k.product_name AND {SIGNATURE_DAY_SQL} = k.day
+            ORDER BY 1, 2, 3
+            """
+        ),
+        tz=app.config["TIMEZONE"].zone,
+        **params,
+    )
+    for key, prices in groupby(tqdm(rows, desc="Price sketches"), key=lambda r: (r["region"], r["product_name"], r["day"])):
+        for r in prices:
+            sketches[key].add(r["price"])
+
+    # schema is created outside of the transaction, dataset doesn't support changing it inside
+    price_sketches.create_column("region", db.types.text)
+    price_sketches.create_column("product_name", db.types.text)
+    price_sketches.create_column("day", db.types.date)
+    price_sketches.create_column("count", db.types.bigint)
+    price_sketches.create_column("sketch", db.types.text)
+
+    with db:
+        db.executable.execute(
+            text(
+                "DELETE FROM price_sketches WHERE (region, product_name, day) IN "
+                + "(SELECT * FROM unnest(:regions, :products, :days))"
+            ),
+            **params,
+        )
+
+        price_sketches.insert_many(
+            [
+                {
+                    "region": region,
+                    "product_name": product_name,
+                    "day": day,
+                    "count": sketch.count,
+                    "sketch": sketch.dumps(),
+                }
+                for (region, product_name, day), sketch in sketches.items()
+                # days left without contracts after an update are just removed
+                if sketch.count
+            ]
+        )
+
+
+def get_since_day(since):
+    since_day = since.date()
+    if since.time() != datetime.min.time():
+        since_day += timedelta(days=1)
+
+    return since_day
+
+
+def merge_price_quantiles(sketch_rows):
+    merged = PriceSketch()
+    for r in sketch_rows:
+        merged.merge(PriceSketch.loads(r["sketch"]))
 
-    periods = (
-        ("За останню добу", relativedelta(days=-1)),
-        ("За останній тиждень", relativedelta(days=-7)),
-        ("За останній місяць", relativedelta(months=-1)),
-        ("За весь час", relativedelta(years=-100)),
+    if merged.count:
+        return merged.quantiles(QUANTILES)
+
+
+def get_price_quantiles_since(region, product_name, since):
+    """
+    Merges daily price sketches to estimate price quantiles over the period,
+    so the cost depends on the number of days, not the number of contracts
+    """
+    return merge_price_quantiles(
+        price_sketches.find(region=region, product_name=product_name, day={">=": get_since_day(since)})
+    )
+
+
+def format_quantiles(quantiles):
+    if not quantiles:
+        return ""
+
+    # single line, so the stats button text stays within 250 characters allowed by Viber
+    return (
+        f"Медіана {quantiles[0.5]:.2f} ({quantiles[0.25]:.2f}–{quantiles[0.75]:.2f}), "
+        + f"p90 {quantiles[0.9]:.2f} грн."
     )
 
+
+STATS_PERIODS = (
+    ("За останню добу", relativedelta(days=-1)),
+    ("За останній тиждень", relativedelta(days=-7)),
+    ("За останній місяць", relativedelta(months=-1)),
+    ("За весь час", relativedelta(years=-100)),
+)
+
+
+def get_product_stats(region, product_name):
+    now = datetime.now(app.config["TIMEZONE"])
+
     res = []
-    for label, period in periods:
+    for label, period in STATS_PERIODS:
         r = get_product_stats_since(region, product_name, now + period)
 
         if r is not None:
             r["since"] = now + period
+            r["quantiles"] = get_price_quantiles_since(region, product_name, now + period)
             res.append((label, r))
 
     if res:
@@ -130,97 +266,516 @@ def unsubscribe(user_id, uuid):
     return subscriptions.delete(user_id=user_id, uuid=uuid)
 
 
+def refine_record(rec, sheet):
+    refined_rec = {}
+
+    for k, v in rec.items():
+        if k is None:
+            continue
+
+        k = str(k).lower().strip()
+        if isinstance(v, str):
+            v = v.strip()
+        elif v is None:
+            v = ""
+
+        if not k:
+            continue
+
+        if k not in HEADERS:
+            app.logger.warning(f"Cannot parse header record {k}, aborting current sheet {sheet}")
+            raise InvalidSheet()
+
+        new_k = HEADERS[k]
+
+        if new_k == "product_name":
+            if str(v).lower() not in PRODUCT_CATEGORIES:
+                app.logger.warning(f"Cannot parse product_name {v}, skipping rec {rec}")
+                raise InvalidRecord()
+
+            refined_rec[new_k] = PRODUCT_CATEGORIES[str(v).lower()]
+        elif new_k == "region":
+            if str(v).lower() not in REGIONS:
+                app.logger.warning(f"Cannot parse region {v}, skipping rec {rec}")
+                raise InvalidRecord()
+
+            refined_rec[new_k] = REGIONS[str(v).lower()]
+        elif new_k == "product_details":
+            refined_rec[new_k] = v
+            refined_rec["product_hash"] = str(v).lower().strip()
+        elif new_k in ["price", "total_amount"]:
+            try:
+                refined_rec[new_k] = parse_amount(v)
+            except ValueError:
+                app.logger.warning(f"Cannot parse field {new_k} {v}, skipping rec {rec}")
+                raise InvalidRecord()
+        elif new_k in ["participants"]:
+            try:
+                refined_rec[new_k] = parse_int(v)
+            except ValueError:
+                app.logger.warning(f"Cannot parse number of participants {v}, skipping rec {rec}")
+                raise InvalidRecord()
+        elif new_k in ["signature_date"]:
+            try:
+                if not isinstance(v, datetime):
+                    v = dt_parse(v, dayfirst=True)
+                refined_rec[new_k] = app.config["TIMEZONE"].localize(v)
+            except (DateParserError, TypeError):
+                app.logger.warning(f"Cannot parse date of signature {v}, skipping rec {rec}")
+                raise InvalidRecord()
+        else:
+            refined_rec[new_k] = v
+
+    if refined_rec and not refined_rec.get("contract_id"):
+        app.logger.warning(f"Contract id is missing, skipping rec {rec}")
+        raise InvalidRecord()
+
+    return refined_rec
+
+
+PROCUREMENTS_COLUMNS = {
+    "contract_id": db.types.text,
+    "signature_date": db.types.datetime,
+    "buyer": db.types.text,
+    "seller": db.types.text,
+    "total_amount": db.types.float,
+    "participants": db.types.bigint,
+    "product_name": db.types.text,
+    "product_details": db.types.text,
+    "product_hash": db.types.text,
+    "price": db.types.float,
+    "region": db.types.text,
+}
+
+
+def dedupe_procurements():
+    """
+    Removes rows which prevent the unique key from being created: older copies of the same contract
+    and contracts without id, which can't be updated by the key anyway. Returns removed rows
+    """
+    return list(
+        db.executable.execute(
+            text(
+                f"""
+                DELETE FROM procurements p
+                WHERE p.contract_id IS NULL OR p.id IN (
+                    SELECT id FROM (
+                        SELECT id, row_number() OVER (
+                            PARTITION BY contract_id, product_name, coalesce(product_hash, '') ORDER BY id DESC
+                        ) AS n
+                        FROM procurements WHERE contract_id IS NOT NULL AND product_name IS NOT NULL
+                    ) copies WHERE n > 1
+                )
+                RETURNING p.region, p.product_name, {SIGNATURE_DAY_SQL} AS day
+                """
+            ),
+            tz=app.config["TIMEZONE"].zone,
+        )
+    )
+
+
+def ensure_procurements_schema():
+    """
+    Creates all the procurements columns and the unique key upfront, so parallel imports
+    neither race on ALTER TABLE nor insert duplicates of the same contract.
+    Tables created before the unique key are deduplicated first, price sketch keys
+    of the removed rows are returned
+    """
+    for name, column_type in PROCUREMENTS_COLUMNS.items():
+        procurements.create_column(name, column_type)
+
+    if db.executable.execute(text("SELECT to_regclass('procurements_contract_key')")).scalar() is not None:
+        return set()
+
+    with db:
+        removed = dedupe_procurements()
+        db.executable.execute(
+            text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS procurements_contract_key "
+                + "ON procurements (contract_id, product_name, coalesce(product_hash, ''))"
+            )
+        )
+
+    if removed:
+        app.logger.warning(f"{len(removed)} duplicated contracts or contracts without id removed")
+
+    return {
+        (r["region"], r["product_name"], r["day"])
+        for r in removed
+        if r["day"] is not None and r["region"] is not None and r["product_name"] is not None
+    }
+
+
+def upsert_procurement(rec):
+    """
+    Atomic replacement for procurements.upsert. Returns None if the stored contract already has
+    the same values, otherwise a row with the updated flag and the region and day the contract
+    had before the update (None for inserted contracts)
+    """
+    columns = sorted(rec)
+    return db.executable.execute(
+        text(
+            f"""
+            WITH old AS (
+                SELECT p.region, {SIGNATURE_DAY_SQL} AS day FROM procurements p
+                WHERE p.contract_id = :key_contract_id AND p.product_name = :key_product_name
+                AND coalesce(p.product_hash, '') = coalesce(:key_product_hash, '')
+            )
+            INSERT INTO procurements ({', '.join(columns)}) VALUES ({', '.join(':' + c for c in columns)})
+            ON CONFLICT (contract_id, product_name, coalesce(product_hash, '')) DO UPDATE
+            SET {', '.join(f"{c} = EXCLUDED.{c}" for c in columns)}
+            WHERE ({', '.join(f"procurements.{c}" for c in columns)}) IS DISTINCT FROM
+                ({', '.join(f"EXCLUDED.{c}" for c in columns)})
+            RETURNING xmax <> 0 AS updated, (SELECT region FROM old) AS old_region, (SELECT day FROM old) AS old_day
+            """
+        ).execution_options(autocommit=True),  # sqlalchemy doesn't detect the statement starting with WITH as DML
+        key_contract_id=rec.get("contract_id"),
+        key_product_name=rec.get("product_name"),
+        key_product_hash=rec.get("product_hash"),
+        tz=app.config["TIMEZONE"].zone,
+        **rec,
+    ).fetchone()
+
+
+DELTA_SUM_FIELDS = ("contracts", "count", "total", "price_sum", "price_count")
+DELTA_FIELDS = DELTA_SUM_FIELDS + ("min", "max", "since_day")
+
+
+def get_contract_delta(rec):
+    price = rec.get("price")
+    total_amount = rec.get("total_amount")
+
+    return {
+        "contracts": 1,
+        "count": int(total_amount is not None),
+        "total": total_amount or 0.0,
+        "price_sum": price or 0.0,
+        "price_count": int(price is not None),
+        "min": price,
+        "max": price,
+        "since_day": rec["signature_date"].date(),
+    }
+
+
+def merge_deltas(delta, other):
+    """
+    Merges aggregates of new contracts, so the alert can show the stats of new contracts only
+    """
+    if delta is None:
+        return {k: other[k] for k in DELTA_FIELDS}
+
+    for k in DELTA_SUM_FIELDS:
+        delta[k] += other[k]
+
+    for k, f in (("min", min), ("max", max), ("since_day", min)):
+        values = [v for v in (delta[k], other[k]) if v is not None]
+        delta[k] = f(values) if values else None
+
+    return delta
+
+
+def merge_new_contracts(new_contracts, other):
+    for pair, delta in other.items():
+        new_contracts[pair] = merge_deltas(new_contracts.get(pair), delta)
+
+
+def import_records(records, sheet, counters, sketch_keys, new_contracts):
+    """
+    Normalizes and upserts records of one sheet, updating counters, the set of
+    (region, product_name, day) keys of price sketches affected by inserted or changed contracts
+    and the aggregates of inserted contracts per (region, product_name). Raises InvalidSheet on unknown headers
+    """
+    for rec in records:
+        try:
+            refined_rec = refine_record(rec, sheet)
+        except InvalidRecord:
+            counters["invalid"] += 1
+            continue
+
+        if not refined_rec:
+            continue
+
+        res = upsert_procurement(refined_rec)
+        if res is None:
+            counters["unchanged"] += 1
+            continue
+
+        if refined_rec.get("signature_date") and refined_rec.get("region") and refined_rec.get("product_name"):
+            sketch_keys.add((refined_rec["region"], refined_rec["product_name"], refined_rec["signature_date"].date()))
+
+        if res["updated"]:
+            counters["updated"] += 1
+            # the price has to be removed from the sketch of the day and region the contract had before
+            if res["old_day"] is not None and res["old_region"] is not None and refined_rec.get("product_name"):
+                sketch_keys.add((res["old_region"], refined_rec["product_name"], res["old_day"]))
+        else:
+            counters["inserted"] += 1
+            if refined_rec.get("signature_date") and refined_rec.get("region") and refined_rec.get("product_name"):
+                merge_new_contracts(
+                    new_contracts,
+                    {(refined_rec["region"], refined_rec["product_name"]): get_contract_delta(refined_rec)},
+                )
+
+
+def log_import_counters(counters):
+    app.logger.info(f"Sheets processed: {counters['useful_sheets']}, sheets skipped: {counters['invalid_sheets']}")
+    app.logger.info(
+        f"Records added: {counters['inserted']}, records updated: {counters['updated']}, "
+        + f"records unchanged: {counters['unchanged']}, records skipped: {counters['invalid']}"
+    )
+
+
+SYNC_DELTAS_COLUMNS = {
+    "region": db.types.text,
+    "product_name": db.types.text,
+    "synced_at": db.types.datetime,
+    "contracts": db.types.bigint,
+    "count": db.types.bigint,
+    "total": db.types.float,
+    "price_sum": db.types.float,
+    "price_count": db.types.bigint,
+    "min": db.types.float,
+    "max": db.types.float,
+    "since_day": db.types.date,
+    "status": db.types.text,
+    "attempts": db.types.bigint,
+    "worker": db.types.text,
+    "claimed_at": db.types.datetime,
+    "finished_at": db.types.datetime,
+}
+
+
+def ensure_sync_deltas():
+    """
+    Creates the columns upfront, otherwise dataset would guess their types from the first row,
+    which can have no prices
+    """
+    with schema_lock(db):
+        for name, column_type in SYNC_DELTAS_COLUMNS.items():
+            sync_deltas.create_column(name, column_type)
+
+
+def record_sync_deltas(new_contracts):
+    """
+    Stores (region, product_name) pairs which received new contracts during the sync
+    together with the aggregates of those contracts.
+    Pending rows are claimed by send_instant_alerts in the order of their ids
+    """
+    synced_at = datetime.now(app.config["TIMEZONE"])
+
+    ensure_sync_deltas()
+    sync_deltas.insert_many(
+        [
+            dict(delta, region=region, product_name=product_name, synced_at=synced_at, status="pending", attempts=0)
+            for (region, product_name), delta in new_contracts.items()
+        ]
+    )
+
+
+def finish_import(purge, sketch_keys, new_contracts, alerts=True):
+    if purge:
+        procurements.create_index(["product_name", "region", "signature_date"])
+
+    rebuild_price_sketches(sorted(sketch_keys))
+    if purge:
+        price_sketches.create_index(["region", "product_name", "day"])
+
+    mark_synced(meta, app.config["TIMEZONE"])
+
+    if purge or not alerts:
+        # after the purge or a backfill contracts are new only to the database, not to subscribers
+        app.logger.info("Skipping instant alerts")
+    elif new_contracts:
+        record_sync_deltas(new_contracts)
+        send_instant_alerts()
+
+
 @app.cli.command("sync_spreadsheet")
 @click.option("--purge", default=False, is_flag=True)
 def sync_spreadsheet(purge):
-    inserted_count = 0
-    updated_count = 0
-    invalid_count = 0
-    useful_sheets = 0
-    invalid_sheets = 0
+    counters = Counter()
+    sketch_keys = set()
+    new_contracts = {}
 
     gc = gspread.service_account(os.path.join("keys", app.config["GDRIVE_KEY"]))
     sp = gc.open_by_key(app.config["GDRIVE_SPREADSHEET"])
 
     if purge:
         procurements.drop()
+        price_sketches.drop()
+    sketch_keys |= ensure_procurements_schema()
+
     for sheet_num, sheet in enumerate(tqdm(sp.worksheets(), desc="Sheets")):
         try:
-            for rec in tqdm(sheet.get_all_records(), desc=f"Records in sheet {sheet_num + 1}"):
-                refined_rec = {}
-
-                try:
-                    for k, v in rec.items():
-                        k = k.lower().strip()
-                        if isinstance(v, str):
-                            v = v.strip()
-
-                        if not k:
-                            continue
-
-                        if k not in HEADERS:
-                            app.logger.warning(f"Cannot parse header record {k}, aborting current sheet {sheet}")
-                            raise InvalidSheet()
-
-                        new_k = HEADERS[k]
-
-                        if new_k == "product_name":
-                            if v.lower() not in PRODUCT_CATEGORIES:
-                                app.logger.warning(f"Cannot parse product_name {v}, skipping rec {rec}")
-                                raise InvalidRecord()
-
-                            refined_rec[new_k] = PRODUCT_CATEGORIES[v.lower()]
-                        elif new_k == "region":
-                            if v.lower() not in REGIONS:
-                                app.logger.warning(f"Cannot parse region {v}, skipping rec {rec}")
-                                raise InvalidRecord()
-
-                            refined_rec[new_k] = REGIONS[v.lower()]
-                        elif new_k == "product_details":
-                            refined_rec[new_k] = v
-                            refined_rec["product_hash"] = v.lower().strip()
-                        elif new_k in ["price", "total_amount"]:
-                            try:
-                                refined_rec[new_k] = parse_amount(v)
-                            except ValueError:
-                                app.logger.warning(f"Cannot parse field {new_k} {v}, skipping rec {rec}")
-                                raise InvalidRecord()
-                        elif new_k in ["participants"]:
-                            try:
-                                refined_rec[new_k] = parse_int(v)
-                            except ValueError:
-                                app.logger.warning(f"Cannot parse number of participants {v}, skipping rec {rec}")
-                                raise InvalidRecord()
-                        elif new_k in ["signature_date"]:
-                            try:
-                                refined_rec[new_k] = app.config["TIMEZONE"].localize(dt_parse(v, dayfirst=True))
-                            except DateParserError:
-                                app.logger.warning(f"Cannot parse date of signature {v}, skipping rec {rec}")
-                                raise InvalidRecord()
-                        else:
-                            refined_rec[new_k] = v
-
-                    update = procurements.upsert(refined_rec, ["contract_id", "product_name", "product_hash"])
-
-                    if update == True:
-                        updated_count += 1
-                    else:
-                        inserted_count += 1
-                except InvalidRecord:
-                    invalid_count += 1
-                    continue
-
-            useful_sheets += 1
+            import_records(
+                tqdm(sheet.get_all_records(), desc=f"Records in sheet {sheet_num + 1}"),
+                sheet,
+                counters,
+                sketch_keys,
+                new_contracts,
+            )
+            counters["useful_sheets"] += 1
         except InvalidSheet as e:
-            invalid_sheets += 1
+            counters["invalid_sheets"] += 1
+
+    finish_import(purge, sketch_keys, new_contracts)
+    log_import_counters(counters)
+
+
+def iter_xlsx_sheets(path):
+    """
+    Yields (sheet title, records generator) pairs, reading the workbook in read-only mode
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+
+            yield ws.title, (dict(zip(header, row)) for row in rows if any(v is not None for v in row))
+    finally:
+        wb.close()
+
+
+def iter_csv_sheets(path):
+    with open(path, newline="", encoding="utf-8-sig") as fp:
+        yield os.path.basename(path), csv.DictReader(fp)
+
+
+def import_one_file(path):
+    """
+    Imports a single local dump, returns counters, price sketch keys and new contracts.
+    Runs in a separate process when import_file is called with several workers
+    """
+    counters = Counter()
+    sketch_keys = set()
+    new_contracts = {}
+
+    if path.lower().endswith(".csv"):
+        sheets = iter_csv_sheets(path)
+    else:
+        sheets = iter_xlsx_sheets(path)
+
+    for title, records in sheets:
+        try:
+            import_records(records, f"{path}:{title}", counters, sketch_keys, new_contracts)
+            counters["useful_sheets"] += 1
+        except InvalidSheet:
+            counters["invalid_sheets"] += 1
+
+    return counters, sketch_keys, new_contracts
+
+
+@app.cli.command("import_file")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--purge", default=False, is_flag=True)
+@click.option("--workers", default=1)
+@click.option("--alerts", default=False, is_flag=True, help="Send instant alerts about the imported contracts")
+def import_file(paths, purge, workers, alerts):
+    counters = Counter()
+    sketch_keys = set()
+    new_contracts = {}
 
     if purge:
-        procurements.create_index(["product_name", "region", "signature_date"])
+        procurements.drop()
+        price_sketches.drop()
+
+    sketch_keys |= ensure_procurements_schema()
+
+    if workers > 1 and len(paths) > 1:
+        # spawn gives every worker its own database connection instead of a forked one
+        with multiprocessing.get_context("spawn").Pool(min(workers, len(paths))) as pool:
+            results = pool.imap_unordered(import_one_file, paths)
+            for file_counters, file_keys, file_contracts in tqdm(results, total=len(paths), desc="Files"):
+                counters.update(file_counters)
+                sketch_keys |= file_keys
+                merge_new_contracts(new_contracts, file_contracts)
+    else:
+        for path in tqdm(paths, desc="Files"):
+            file_counters, file_keys, file_contracts = import_one_file(path)
+            counters.update(file_counters)
+            sketch_keys |= file_keys
+            merge_new_contracts(new_contracts, file_contracts)
 
-    app.logger.info(f"Sheets processed: {useful_sheets}, sheets skipped: {invalid_sheets}")
-    app.logger.info(
-        f"Records added: {inserted_count}, records updated: {updated_count}, records skipped: {invalid_count}"
-    )
+    finish_import(purge, sketch_keys, new_contracts, alerts=alerts)
+    log_import_counters(counters)
+
+
+@app.cli.command("rebuild_sketches")
+def rebuild_sketches():
+    keys = set()
+
+    for r in db.query(
+        f"SELECT DISTINCT p.region, p.product_name, {SIGNATURE_DAY_SQL} AS day FROM procurements p",
+        tz=app.config["TIMEZONE"].zone,
+    ):
+        if r["day"] is not None and r["region"] is not None and r["product_name"] is not None:
+            keys.add((r["region"], r["product_name"], r["day"]))
+
+    price_sketches.drop()
+    rebuild_price_sketches(sorted(keys))
+    price_sketches.create_index(["region", "product_name", "day"])
+
+
+def stats_match(sql_stat, np_stat):
+    if sql_stat is None or np_stat is None:
+        return sql_stat is None and np_stat is None
+
+    if sql_stat["count"] != np_stat["count"]:
+        return False
+
+    for k in ["total", "min", "avg", "max"]:
+        if sql_stat[k] is None or np_stat[k] is None:
+            if sql_stat[k] is not None or np_stat[k] is not None:
+                return False
+        elif not math.isclose(float(sql_stat[k]), np_stat[k], rel_tol=1e-9, abs_tol=0.01):
+            return False
+
+    return True
+
+
+@app.cli.command("benchmark_stats")
+@click.option("--repeat", default=5)
+def benchmark_stats(repeat):
+    from analytics import ProcurementsSnapshot
+
+    tz = app.config["TIMEZONE"]
+    now = datetime.now(tz)
+    sinces = [now + period for _, period in STATS_PERIODS]
+    pairs = [(r, p) for r in sorted(set(REGIONS.values())) for p in sorted(set(PRODUCT_CATEGORIES.values()))]
+
+    started = time.perf_counter()
+    local_snapshot = ProcurementsSnapshot.load(db, tz)
+    app.logger.info(f"Snapshot of {len(local_snapshot)} records loaded in {time.perf_counter() - started:.3f}s")
+
+    mismatches = 0
+    for region, product_name in pairs:
+        for since in sinces:
+            sql_stat = get_product_stats_since(region, product_name, since, use_sql=True)
+            np_stat = local_snapshot.get_product_stats_since(region, product_name, since)
+
+            if not stats_match(sql_stat, np_stat):
+                mismatches += 1
+                app.logger.warning(f"Stats mismatch for {region}/{product_name} since {since}: {sql_stat} vs {np_stat}")
+
+    timings = {}
+    for engine in ["sql", "numpy"]:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for region, product_name in pairs:
+                for since in sinces:
+                    if engine == "sql":
+                        get_product_stats_since(region, product_name, since, use_sql=True)
+                    else:
+                        local_snapshot.get_product_stats_since(region, product_name, since)
+
+        timings[engine] = (time.perf_counter() - started) / (repeat * len(pairs))
+
+    app.logger.info(f"Mismatches between engines: {mismatches}")
+    for engine, per_pair in timings.items():
+        app.logger.info(f"{engine}: {per_pair * 1000:.3f}ms per get_product_stats call")
 
 
 @app.route("/start", methods=["GET"])
@@ -230,21 +785,51 @@ def start():
 
 @app.route("/export/<product_name>/<region>/<since>", methods=["GET"])
 def export(product_name, region, since):
-    try:
-        assert product_name in PRODUCT_CATEGORIES.values()
-        assert region in REGIONS.values()
-        dt_since = dt_parse(since)
-    except (AssertionError, DateParserError):
+    dt_since = parse_export_params(product_name, region, since)
+    if dt_since is None:
         abort(403, description="Помилка в параметрах")
 
     q = procurements.find(
         product_name=product_name, region=region, signature_date={">=": dt_since}, order_by="-signature_date"
     )
+    content, headers = build_export_report(
+        q, get_price_quantiles_since(region, product_name, dt_since), product_name, region
+    )
+
+    return Response(content, headers=headers)
+
 
+def parse_export_params(product_name, region, since):
+    try:
+        assert product_name in PRODUCT_CATEGORIES.values()
+        assert region in REGIONS.values()
+        return dt_parse(since)
+    except (AssertionError, DateParserError):
+        return None
+
+
+def build_export_report(q, quantiles, product_name, region):
+    """
+    Renders procurements and price quantiles into xlsx, returns its content and response headers
+    """
     wb = Workbook()
     ws = wb.active
     bold = Font(bold=True)
     ws.title = "Звіт по закупівлях"
+
+    quantiles = quantiles or {}
+    summary = [
+        ("Ціна, 25-й перцентиль", quantiles.get(0.25)),
+        ("Медіанна ціна", quantiles.get(0.5)),
+        ("Ціна, 75-й перцентиль", quantiles.get(0.75)),
+        ("Ціна, 90-й перцентиль", quantiles.get(0.9)),
+    ]
+
+    for i, (h, v) in enumerate(summary):
+        ws.cell(row=1, column=i + 1, value=h).font = bold
+        ws.cell(row=2, column=i + 1, value=round(v, 2) if v is not None else None)
+
+    header_row = 4
     header = [
         "Ідентифікатор договору",
         "Дата підписання",
@@ -259,15 +844,15 @@ def export(product_name, region, since):
     ]
 
     for i, h in enumerate(header):
-        cell = ws.cell(row=1, column=i + 1, value=h)
+        cell = ws.cell(row=header_row, column=i + 1, value=h)
         cell.font = bold
         ws.column_dimensions[get_column_letter(i + 1)].width = len(h) + 3
 
-    ws.freeze_panes = "B2"
+    ws.freeze_panes = f"B{header_row + 1}"
 
     for j, r in enumerate(q):
         contract_cell = ws.cell(
-            row=j + 2,
+            row=header_row + j + 1,
             column=1,
             value=r["contract_id"],
         )
@@ -275,33 +860,37 @@ def export(product_name, region, since):
         contract_cell.hyperlink = "https://prozorro.gov.ua/tender/{}".format(r["contract_id"][:-3])
         contract_cell.style = "Hyperlink"
 
-        ws.cell(row=j + 2, column=2, value=r["signature_date"])
-        ws.cell(row=j + 2, column=3, value=r["buyer"])
-        ws.cell(row=j + 2, column=4, value=r["seller"])
-        ws.cell(row=j + 2, column=5, value=r["total_amount"])
-        ws.cell(row=j + 2, column=6, value=r["participants"])
-        ws.cell(row=j + 2, column=7, value=r["product_name"])
-        ws.cell(row=j + 2, column=8, value=r["product_details"])
-        ws.cell(row=j + 2, column=9, value=r["price"])
-        ws.cell(row=j + 2, column=10, value=r["region"])
-
-    return Response(
+        ws.cell(row=header_row + j + 1, column=2, value=r["signature_date"])
+        ws.cell(row=header_row + j + 1, column=3, value=r["buyer"])
+        ws.cell(row=header_row + j + 1, column=4, value=r["seller"])
+        ws.cell(row=header_row + j + 1, column=5, value=r["total_amount"])
+        ws.cell(row=header_row + j + 1, column=6, value=r["participants"])
+        ws.cell(row=header_row + j + 1, column=7, value=r["product_name"])
+        ws.cell(row=header_row + j + 1, column=8, value=r["product_details"])
+        ws.cell(row=header_row + j + 1, column=9, value=r["price"])
+        ws.cell(row=header_row + j + 1, column=10, value=r["region"])
+
+    return (
         save_virtual_workbook(wb),
-        headers={
+        {
             "Content-Disposition": f"attachment; filename=report_{translit(region).lower()}_{translit(product_name).replace(' ', '_')}.xlsx",
             "Content-type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         },
     )
 
-    return Response("Everything is ok")
 
+def get_export_url(region, product_name, since):
+    return app.config["WEBHOOK_URL"] + app.url_map.bind("").build(
+        "export", {"region": region, "product_name": product_name, "since": since}
+    )
 
-@app.route("/", methods=["POST"])
-def incoming():
-    app.logger.debug(f"received request. post data: {request.get_data()}")
-
-    viber_request = viber.parse_request(request.get_data().decode("utf8"))
 
+def handle_viber_request(viber_request):
+    """
+    Bot commands logic, shared by the flask webhook and the asgi server.
+    Instead of calling the storage and Viber API directly it yields calls as (name, *args) tuples
+    and receives their results, see run_handler and SYNC_HANDLERS
+    """
     if isinstance(viber_request, ViberMessageRequest):
         message = viber_request.message
         chunks = message.text.split(":")
@@ -312,7 +901,8 @@ def incoming():
             command = chunks[0]
 
         if command == "start":
-            viber.send_messages(
+            yield (
+                "send_messages",
                 viber_request.sender.id,
                 TextMessage(
                     text="Для того щоб розпочати роботу оберіть внизу область по котрій ви хочете отримувати цінову інформацію",
@@ -320,7 +910,8 @@ def incoming():
                 ),
             )
         elif command == "help":
-            viber.send_messages(
+            yield (
+                "send_messages",
                 viber_request.sender.id,
                 TextMessage(
                     text="Бот дозволяє вам отримувати актуальну інформацію щодо цінових пропозицій на різні категорії товарів а також підписуватися на такі цінові пропозиції",
@@ -328,7 +919,7 @@ def incoming():
                 ),
             )
         elif command == "subscriptions":
-            subs = get_active_subscriptions(viber_request.sender.id)
+            subs = yield ("get_active_subscriptions", viber_request.sender.id)
 
             if subs:
                 carousel = {
@@ -378,13 +969,13 @@ def incoming():
             else:
                 response_message = TextMessage(text="У вас поки що нема активних підписок", keyboard=VIBER_MENU_KBD)
 
-            viber.send_messages(viber_request.sender.id, response_message)
+            yield ("send_messages", viber_request.sender.id, response_message)
         elif command == "unsubscribe":
-            if unsubscribe(viber_request.sender.id, chunks[1]):
+            if (yield ("unsubscribe", viber_request.sender.id, chunks[1])):
                 response_message = TextMessage(text="Ви були успішно відписані", keyboard=VIBER_MENU_KBD)
             else:
                 response_message = TextMessage(text="Виникла помилка", keyboard=VIBER_MENU_KBD)
-            viber.send_messages(viber_request.sender.id, response_message)
+            yield ("send_messages", viber_request.sender.id, response_message)
         elif command == "subscribe":
             if (
                 len(chunks) < 4
@@ -392,7 +983,8 @@ def incoming():
                 or chunks[2] not in PRODUCT_CATEGORIES.values()
                 or chunks[3] not in SUBSCRIPTION_TYPES.values()
             ):
-                viber.send_messages(
+                yield (
+                    "send_messages",
                     viber_request.sender.id,
                     TextMessage(
                         text="Вибачте, не зрозумів, спробуйте почати з початку або подивитися довідку",
@@ -400,10 +992,9 @@ def incoming():
                     ),
                 )
 
-            if subscribe_user(
-                user_id=viber_request.sender.id, region=chunks[1], product_name=chunks[2], period=chunks[3]
-            ):
-                viber.send_messages(
+            if (yield ("subscribe_user", viber_request.sender.id, chunks[1], chunks[2], chunks[3])):
+                yield (
+                    "send_messages",
                     viber_request.sender.id,
                     TextMessage(
                         text=f"Дякую, ви успішно підписані на оновлення по категорії ”{chunks[2]}” в області ”{chunks[1]}”",
@@ -411,7 +1002,8 @@ def incoming():
                     ),
                 )
             else:
-                viber.send_messages(
+                yield (
+                    "send_messages",
                     viber_request.sender.id,
                     TextMessage(
                         text=f"Ви вже підписані на оновлення по категорії ”{chunks[2]}” в області ”{chunks[1]}”. Ви можете подивитися активні підписки у розділі ”Ваші підписки”",
@@ -420,23 +1012,26 @@ def incoming():
                 )
         elif command == "region":
             if len(chunks) > 1 and chunks[1] in REGIONS.values():
-                viber.send_messages(
+                yield (
+                    "send_messages",
                     viber_request.sender.id,
                     TextMessage(text="Оберіть категорію товару", keyboard=get_viber_categories_kbd(chunks[1])),
                 )
             else:
-                viber.send_messages(
+                yield (
+                    "send_messages",
                     viber_request.sender.id,
                     TextMessage(text="Вибачте, не зрозумів, оберіть, будь ласка, область", keyboard=VIBER_REGIONS_KBD),
                 )
         elif command == "product_name":
             if len(chunks) < 3 or chunks[1] not in REGIONS.values() or chunks[2] not in PRODUCT_CATEGORIES.values():
-                viber.send_messages(
+                yield (
+                    "send_messages",
                     viber_request.sender.id,
                     TextMessage(text="Вибачте, не зрозумів, оберіть, будь ласка, область", keyboard=VIBER_REGIONS_KBD),
                 )
             else:
-                stats = get_product_stats(chunks[1], chunks[2])
+                stats = yield ("get_product_stats", chunks[1], chunks[2])
 
                 if stats is None:
                     response_message = TextMessage(
@@ -446,16 +1041,14 @@ def incoming():
 
                 else:
                     carousel = {
-                        "ButtonsGroupRows": 5,
+                        "ButtonsGroupRows": 6,
                         "ButtonsGroupColumns": 6,
                         "BgColor": "#FFFFFF",
                         "Buttons": [],
                     }
 
                     for period, stat in stats.items():
-                        report_url = app.config["WEBHOOK_URL"] + url_for(
-                            "export", region=chunks[1], product_name=chunks[2], since=stat["since"]
-                        )
+                        report_url = get_export_url(chunks[1], chunks[2], stat["since"])
                         carousel["Buttons"].append(
                             {
                                 "ActionBody": report_url,
@@ -464,8 +1057,9 @@ def incoming():
                                 "TextHAlign": "left",
                                 "Text": f"<b>{period}</b>"
                                 + f"\n\nВсього закупівель: {stat['count']}\nНа суму: {stat['total']:.2f} грн.\nМінімальна ціна: {stat['min']:.2f} грн."
-                                + f"\nМаксимальна ціна: {stat['max']:.2f} грн.\nСередня ціна: {stat['avg']:.2f} грн.\n",
-                                "Rows": 4,
+                                + f"\nМаксимальна ціна: {stat['max']:.2f} грн.\nСередня ціна: {stat['avg']:.2f} грн.\n"
+                                + format_quantiles(stat["quantiles"]),
+                                "Rows": 5,
                                 "Columns": 6,
                             }
                         )
@@ -488,7 +1082,8 @@ def incoming():
                         min_api_version=2,
                     )
 
-                viber.send_messages(
+                yield (
+                    "send_messages",
                     viber_request.sender.id,
                     [
                         response_message,
@@ -500,7 +1095,8 @@ def incoming():
                 )
 
     elif isinstance(viber_request, ViberConversationStartedRequest):
-        viber.send_messages(
+        yield (
+            "send_messages",
             viber_request.user.id,
             [
                 TextMessage(
@@ -510,101 +1106,420 @@ def incoming():
             ],
         )
     elif isinstance(viber_request, ViberSubscribedRequest):
-        viber.send_messages(viber_request.sender.id, [TextMessage(None, None, viber_request.get_event_type())])
+        yield ("send_messages", viber_request.sender.id, [TextMessage(None, None, viber_request.get_event_type())])
     elif isinstance(viber_request, ViberFailedRequest):
         app.logger.warning("client failed receiving message. failure: {viber_request}")
 
+
+def run_handler(handler, handlers):
+    result = None
+    try:
+        while True:
+            name, *args = handler.send(result)
+            result = handlers[name](*args)
+    except StopIteration:
+        pass
+
+
+SYNC_HANDLERS = {
+    "send_messages": viber.send_messages,
+    "get_active_subscriptions": get_active_subscriptions,
+    "unsubscribe": unsubscribe,
+    "subscribe_user": subscribe_user,
+    "get_product_stats": get_product_stats,
+}
+
+
+@app.route("/", methods=["POST"])
+def incoming():
+    app.logger.debug(f"received request. post data: {request.get_data()}")
+
+    viber_request = viber.parse_request(request.get_data().decode("utf8"))
+
+    run_handler(handle_viber_request(viber_request), SYNC_HANDLERS)
+
     return Response(status=200)
 
 
+def get_subscription_message(sub, stat, since, now, title=None):
+    if title is None:
+        title = f"Ваша підписка на ”{sub['product_name']}” в області ”{sub['region']}”"
+
+    carousel = {
+        "ButtonsGroupRows": 5,
+        "ButtonsGroupColumns": 6,
+        "BgColor": "#FFFFFF",
+        "Buttons": [],
+    }
+
+    report_url = get_export_url(sub["region"], sub["product_name"], since)
+    carousel["Buttons"].append(
+        {
+            "ActionBody": report_url,
+            "ActionType": "open-url",
+            "TextVAlign": "top",
+            "TextHAlign": "left",
+            "Text": f"<b>{title}</b>"
+            + f"\n\nВсього закупівель: {stat['count']}\nНа суму: {stat['total']:.2f} грн.\nМінімальна ціна: {stat['min']:.2f} грн."
+            + f"\nМаксимальна ціна: {stat['max']:.2f} грн.\nСередня ціна: {stat['avg']:.2f} грн.\n"
+            + "Звіт за: {}-{}".format(since.strftime(app.config["DT_FORMAT"]), now.strftime(app.config["DT_FORMAT"])),
+            "Rows": 4,
+            "Columns": 6,
+        }
+    )
+    carousel["Buttons"].append(
+        {
+            "ActionBody": report_url,
+            "ActionType": "open-url",
+            "TextVAlign": "middle",
+            "TextHAlign": "middle",
+            "BgColor": "#aaaaaa",
+            "Text": "<b>Скачати звіт</b>",
+            "Rows": 1,
+            "Columns": 6,
+        }
+    )
+
+    return RichMediaMessage(
+        rich_media=carousel,
+        alt_text="Ваш viber-клієнт дуже застарів, будь ласка, оновить його",
+        min_api_version=2,
+        keyboard=VIBER_MENU_KBD,
+    )
+
+
+SUBSCRIPTION_OFFSETS = {
+    "daily": relativedelta(days=-1),
+    "weekly": relativedelta(days=-7),
+    "monthly": relativedelta(months=-1),
+}
+
+
+def ensure_delivery_jobs():
+    db.executable.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS delivery_jobs (
+                id serial PRIMARY KEY,
+                subscription_id integer NOT NULL,
+                period text NOT NULL,
+                dt date NOT NULL,
+                status text NOT NULL DEFAULT 'pending',
+                worker text,
+                claimed_at timestamptz,
+                finished_at timestamptz,
+                UNIQUE (subscription_id, dt)
+            )
+            """
+        )
+    )
+    db.executable.execute(text("CREATE INDEX IF NOT EXISTS delivery_jobs_dt_status ON delivery_jobs (dt, status)"))
+
+    ensure_sent_log()
+
+
+def ensure_sent_log():
+    # created once here, so parallel workers don't race for it on the first insert
+    with schema_lock(db):
+        sent_log.create_column("subscription_id", db.types.bigint)
+        sent_log.create_column("dt", db.types.date)
+        sent_log.create_column("status", db.types.text)
+        sent_log.create_column("delta_id", db.types.bigint)
+        sent_log.create_index(["subscription_id", "dt"])
+        sent_log.create_index(["delta_id"])
+
+
+def plan_deliveries(dt, periods):
+    """
+    Creates pending jobs for the day's deliveries. Jobs which already exist are kept as is,
+    so the rerun (or another host) only picks up what wasn't finished
+    """
+    return db.executable.execute(
+        text(
+            """
+            INSERT INTO delivery_jobs (subscription_id, period, dt)
+            SELECT id, period, :dt FROM subscriptions WHERE period = ANY(:periods)
+            ON CONFLICT (subscription_id, dt) DO NOTHING
+            """
+        ),
+        dt=dt,
+        periods=list(periods),
+    ).rowcount
+
+
+def claim_deliveries(dt, worker, batch_size, lease_minutes):
+    """
+    Claims a batch of pending jobs. Rows locked by other workers are skipped, jobs claimed
+    by a crashed worker become available again once the lease expires
+    """
+    return list(
+        db.executable.execute(
+            text(
+                """
+                UPDATE delivery_jobs SET status = 'claimed', worker = :worker, claimed_at = now()
+                WHERE id IN (
+                    SELECT id FROM delivery_jobs
+                    WHERE dt = :dt AND (
+                        status = 'pending'
+                        OR (status = 'claimed' AND claimed_at < now() - make_interval(mins => :lease))
+                    )
+                    ORDER BY id
+                    LIMIT :batch_size
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, subscription_id, period
+                """
+            ),
+            dt=dt,
+            worker=worker,
+            batch_size=batch_size,
+            lease=lease_minutes,
+        )
+    )
+
+
+def finish_delivery(job_id, status):
+    db.executable.execute(
+        text("UPDATE delivery_jobs SET status = :status, finished_at = now() WHERE id = :id"), id=job_id, status=status
+    )
+
+
+def get_delivery_progress(dt):
+    return Counter(
+        {
+            r["status"]: r["count"]
+            for r in db.query("SELECT status, count(*) AS count FROM delivery_jobs WHERE dt = :dt GROUP BY status", dt=dt)
+        }
+    )
+
+
+def deliver_subscriptions(now, batch_size, lease_minutes):
+    """
+    Claims and sends jobs in batches until nothing is left for the day, returns status counters.
+    Runs in a separate process when send_subscriptions is called with several workers
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    counters = Counter()
+    stats_cache = {}
+    started = time.perf_counter()
+
+    while True:
+        jobs = claim_deliveries(now.date(), worker, batch_size, lease_minutes)
+        if not jobs:
+            break
+
+        for job in jobs:
+            status = "fail"
+            try:
+                sub = subscriptions.find_one(id=job["subscription_id"])
+                if sub is None:
+                    status = "skipped"
+                    continue
+
+                since = now + SUBSCRIPTION_OFFSETS[job["period"]]
+                key = (sub["region"], sub["product_name"], job["period"])
+                if key not in stats_cache:
+                    # a few cached queries are cheaper than loading the whole snapshot in every worker
+                    stats_cache[key] = get_product_stats_since(sub["region"], sub["product_name"], since, use_sql=True)
+
+                stat = stats_cache[key]
+                if stat is None:
+                    app.logger.info(f"No stats available for {sub['region']}/{sub['product_name']} since {since}")
+                    status = "empty"
+                    continue
+
+                viber.send_messages(sub["user_id"], [get_subscription_message(sub, stat, since, now)])
+                sent_log.insert({"subscription_id": sub["id"], "dt": now.date(), "status": "ok"})
+                status = "sent"
+            except Exception as e:
+                sent_log.insert({"subscription_id": job["subscription_id"], "dt": now.date(), "status": "fail"})
+                app.logger.error(f"Subscription {job['subscription_id']} raised an error '{e}'")
+            finally:
+                finish_delivery(job["id"], status)
+                counters[status] += 1
+
+        processed = sum(counters.values())
+        app.logger.info(
+            f"Worker {worker}: {processed} processed, {processed / (time.perf_counter() - started):.1f} per second"
+        )
+
+    return counters
+
+
 @app.cli.command("send_subscriptions")
-def send_subscriptions():
+@click.option("--workers", default=1)
+@click.option("--batch-size", default=50)
+def send_subscriptions(workers, batch_size):
     now = datetime.now(app.config["TIMEZONE"])
+    lease_minutes = app.config.get("DELIVERY_LEASE_MINUTES", 30)
 
     periods = ["daily"]
-    if now.date().weekday == 0:
+    if now.date().weekday() == 0:
         periods.append("weekly")
     if now.day == 1:
         periods.append("monthly")
 
-    offsets = {"daily": relativedelta(days=-1), "weekly": relativedelta(days=-7), "monthly": relativedelta(months=-1)}
-
-    first_insert = True
+    ensure_delivery_jobs()
+    planned = plan_deliveries(now.date(), periods)
+    app.logger.info(f"{planned} deliveries planned for {now.date()} ({', '.join(periods)})")
+
+    started = time.perf_counter()
+    counters = Counter()
+    if workers > 1:
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            results = [pool.apply_async(deliver_subscriptions, (now, batch_size, lease_minutes)) for _ in range(workers)]
+            for r in results:
+                counters.update(r.get())
+    else:
+        counters = deliver_subscriptions(now, batch_size, lease_minutes)
 
-    for period in periods:
-        sent_stats = 0
-        since = now + offsets[period]
-        for sub in subscriptions.find(period=period):
-            if sent_log.find_one(subscription_id=sub["id"], dt=now.date()):
-                app.logger.info(f"Skipping subscription {sub['id']} as it was already processed today ({now.date()})")
-                continue
+    elapsed = time.perf_counter() - started
+    processed = sum(counters.values())
+    app.logger.info(
+        f"{counters['sent']} has been sent successfuly, {counters['fail']} failed, "
+        + f"{counters['empty'] + counters['skipped']} skipped in {elapsed:.1f}s ({processed / max(elapsed, 0.001):.1f} per second)"
+    )
 
-            try:
-                stat = get_product_stats_since(sub["region"], sub["product_name"], since)
-                if stat is None:
-                    app.logger.info(f"No stats available for {sub['region']}/{sub['product_name']} since {since}")
-                    continue
+    progress = get_delivery_progress(now.date())
+    leased = ""
+    if progress["claimed"]:
+        leased = (
+            f" ({progress['claimed']} jobs are still leased by running or crashed workers, "
+            + f"they are picked up again once the lease of {lease_minutes} minutes expires)"
+        )
+    app.logger.info(
+        f"Progress for {now.date()}: " + ", ".join(f"{k}: {v}" for k, v in sorted(progress.items())) + leased
+    )
 
-                carousel = {
-                    "ButtonsGroupRows": 5,
-                    "ButtonsGroupColumns": 6,
-                    "BgColor": "#FFFFFF",
-                    "Buttons": [],
-                }
 
-                report_url = url_for(
-                    "export", region=sub["region"], product_name=sub["product_name"], since=since
-                )
-                carousel["Buttons"].append(
-                    {
-                        "ActionBody": report_url,
-                        "ActionType": "open-url",
-                        "TextVAlign": "top",
-                        "TextHAlign": "left",
-                        "Text": f"<b>Ваша підписка на ”{sub['product_name']}” в області ”{sub['region']}”</b>"
-                        + f"\n\nВсього закупівель: {stat['count']}\nНа суму: {stat['total']:.2f} грн.\nМінімальна ціна: {stat['min']:.2f} грн."
-                        + f"\nМаксимальна ціна: {stat['max']:.2f} грн.\nСередня ціна: {stat['avg']:.2f} грн.\n"
-                        + "Звіт за: {}-{}".format(since.strftime(app.config["DT_FORMAT"]), now.strftime(app.config["DT_FORMAT"])),
-                        "Rows": 4,
-                        "Columns": 6,
-                    }
-                )
-                carousel["Buttons"].append(
-                    {
-                        "ActionBody": report_url,
-                        "ActionType": "open-url",
-                        "TextVAlign": "middle",
-                        "TextHAlign": "middle",
-                        "BgColor": "#aaaaaa",
-                        "Text": "<b>Скачати звіт</b>",
-                        "Rows": 1,
-                        "Columns": 6,
-                    }
+def claim_sync_delta(worker, after_id, lease_minutes):
+    """
+    Claims the next pending delta like claim_deliveries does, so overlapping runs don't alert twice.
+    Deltas claimed by a crashed run become available again once the lease expires
+    """
+    return db.executable.execute(
+        text(
+            """
+            UPDATE sync_deltas SET status = 'claimed', worker = :worker, claimed_at = now(), attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM sync_deltas
+                WHERE id > :after_id AND (
+                    status = 'pending'
+                    OR (status = 'claimed' AND claimed_at < now() - make_interval(mins => :lease))
                 )
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+            """
+        ),
+        worker=worker,
+        after_id=after_id,
+        lease=lease_minutes,
+    ).fetchone()
+
+
+def finish_sync_delta(delta_id, status):
+    db.executable.execute(
+        text("UPDATE sync_deltas SET status = :status, finished_at = now() WHERE id = :id"), id=delta_id, status=status
+    )
 
-                viber.send_messages(
-                    sub["user_id"],
-                    [
-                        RichMediaMessage(
-                            rich_media=carousel,
-                            alt_text="Ваш viber-клієнт дуже застарів, будь ласка, оновить його",
-                            min_api_version=2,
-                            keyboard=VIBER_MENU_KBD,
-                        )
-                    ],
-                )
-                sent_log.insert({"subscription_id": sub["id"], "dt": now.date(), "status": "ok"})
-                sent_stats += 1
-            except Exception as e:
-                sent_log.insert({"subscription_id": sub["id"], "dt": now.date(), "status": "fail"})
-                app.logger.error(f"Subscription {sub['id']} raised an error '{e}'")
 
-            if first_insert:
-                sent_log.create_index(["subscription_id", "dt"])
+def send_delta_alerts(delta, now):
+    """
+    Sends the alert about new contracts of the delta to instant subscribers of its (region, product_name) pair.
+    Subscribers which already received it on the previous attempt are skipped. Returns status counters
+    """
+    counters = Counter()
+    if not delta["count"] or not delta["price_count"]:
+        return counters
+
+    region, product_name = delta["region"], delta["product_name"]
+
+    # stats of the new contracts only, older contracts of the same days are not included
+    since = get_day_bounds(delta["since_day"])[0]
+    stat = {
+        "count": delta["count"],
+        "total": delta["total"],
+        "min": delta["min"],
+        "avg": delta["price_sum"] / delta["price_count"],
+        "max": delta["max"],
+    }
+
+    already_sent = {r["subscription_id"] for r in sent_log.find(delta_id=delta["id"], status="ok")}
+
+    for sub in subscriptions.find(region=region, product_name=product_name, period="instant"):
+        if sub["id"] in already_sent:
+            continue
+
+        try:
+            viber.send_messages(
+                sub["user_id"],
+                [
+                    get_subscription_message(
+                        sub,
+                        stat,
+                        since,
+                        now,
+                        title=f"Нових закупівель ”{product_name}” в області ”{region}”: {delta['contracts']}",
+                    )
+                ],
+            )
+            sent_log.insert({"subscription_id": sub["id"], "dt": now.date(), "delta_id": delta["id"], "status": "ok"})
+            counters["sent"] += 1
+        except Exception as e:
+            sent_log.insert({"subscription_id": sub["id"], "dt": now.date(), "delta_id": delta["id"], "status": "fail"})
+            app.logger.error(f"Subscription {sub['id']} raised an error '{e}'")
+            counters["fail"] += 1
+
+    return counters
+
+
+def send_instant_alerts():
+    """
+    Sends alerts about contracts of pending sync deltas, only to instant subscribers
+    of the affected (region, product_name) pairs. Deltas with failed sends are returned
+    to pending and retried by the next run, up to INSTANT_ALERTS_ATTEMPTS times
+    """
+    now = datetime.now(app.config["TIMEZONE"])
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    lease_minutes = app.config.get("DELIVERY_LEASE_MINUTES", 30)
+    max_attempts = app.config.get("INSTANT_ALERTS_ATTEMPTS", 3)
+
+    ensure_sync_deltas()
+    ensure_sent_log()
+
+    counters = Counter()
+    last_id = 0
+    processed = 0
+    while True:
+        # every delta is claimed at most once per run, retries are left to the next one
+        delta = claim_sync_delta(worker, last_id, lease_minutes)
+        if delta is None:
+            break
+
+        last_id = delta["id"]
+        processed += 1
+
+        delta_counters = send_delta_alerts(delta, now)
+        counters.update(delta_counters)
+
+        if not delta_counters["fail"]:
+            finish_sync_delta(delta["id"], "sent")
+        elif delta["attempts"] < max_attempts:
+            finish_sync_delta(delta["id"], "pending")
+        else:
+            finish_sync_delta(delta["id"], "fail")
+
+    app.logger.info(
+        f"{counters['sent']} instant alerts has been sent for {processed} categories, {counters['fail']} failed"
+    )
 
-            first_insert = False
 
-        app.logger.info(f"{sent_stats} has been sent successfuly for period {period}")
+@app.cli.command("send_instant_alerts")
+def send_instant_alerts_command():
+    send_instant_alerts()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,255 @@
+"""
+Asyncio based server for the webhook and export routes, alternative to the flask app:
+
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+Bot commands logic is shared with app.incoming via handle_viber_request,
+only storage and Viber API calls are replaced with asyncpg and httpx ones.
+"""
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import asyncpg
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import Response, RedirectResponse, PlainTextResponse
+from starlette.routing import Route
+
+from app import (
+    app as flask_app,
+    viber,
+    handle_viber_request,
+    parse_export_params,
+    build_export_report,
+    merge_price_quantiles,
+    get_since_day,
+    STATS_PERIODS,
+)
+
+config = flask_app.config
+logger = flask_app.logger
+
+pool = None
+client = None
+handlers = None
+
+
+class AsyncViberSender:
+    """
+    Sends messages the same way viberbot's Api.send_messages does, but without blocking
+    """
+
+    def __init__(self, client, api_url, name, avatar, auth_token):
+        self.client = client
+        self.api_url = api_url
+        self.name = name
+        self.avatar = avatar
+        self.auth_token = auth_token
+
+    async def send_messages(self, to, messages):
+        if not isinstance(messages, list):
+            messages = [messages]
+
+        tokens = []
+        for message in messages:
+            if not message.validate():
+                raise Exception(f"failed validating message: {message}")
+
+            payload = message.to_dict()
+            payload.update(
+                {"auth_token": self.auth_token, "receiver": to, "sender": {"name": self.name, "avatar": self.avatar}}
+            )
+            payload = {k: v for k, v in payload.items() if v is not None}
+
+            response = await self.client.post(f"{self.api_url}/send_message", json=payload)
+            response.raise_for_status()
+            result = response.json()
+
+            if result["status"] != 0:
+                raise Exception(f"failed with status: {result['status']}, message: {result.get('status_message')}")
+
+            tokens.append(result["message_token"])
+
+        return tokens
+
+
+async def get_active_subscriptions(user_id):
+    return [dict(r) for r in await pool.fetch("SELECT * FROM subscriptions WHERE user_id = $1", user_id)]
+
+
+async def unsubscribe(user_id, uuid):
+    status = await pool.execute("DELETE FROM subscriptions WHERE user_id = $1 AND uuid = $2", user_id, uuid)
+    return status != "DELETE 0"
+
+
+async def subscribe_user(user_id, region, product_name, period):
+    # dt is a timestamp without time zone, postgres converts the aware value to the session timezone
+    # like psycopg2 does in the flask app
+    now = datetime.now(config["TIMEZONE"])
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            status = await conn.execute(
+                "UPDATE subscriptions SET uuid = $5, dt = $6::timestamptz "
+                + "WHERE user_id = $1 AND region = $2 AND product_name = $3 AND period = $4",
+                user_id,
+                region,
+                product_name,
+                period,
+                str(uuid4()),
+                now,
+            )
+            if status != "UPDATE 0":
+                return False
+
+            await conn.execute(
+                "INSERT INTO subscriptions (user_id, region, product_name, period, uuid, dt) "
+                + "VALUES ($1, $2, $3, $4, $5, $6::timestamptz)",
+                user_id,
+                region,
+                product_name,
+                period,
+                str(uuid4()),
+                now,
+            )
+            return True
+
+
+async def get_product_stats_since(region, product_name, since):
+    r = await pool.fetchrow(
+        "SELECT count(total_amount) AS count, sum(total_amount) AS total, "
+        + "min(price) AS min, avg(price) AS avg, max(price) AS max FROM procurements "
+        + "WHERE product_name = $1 AND region = $2 AND signature_date >= $3::timestamptz",
+        product_name,
+        region,
+        since,
+    )
+
+    if r["count"] > 0:
+        return dict(r)
+
+
+async def get_price_quantiles_since(region, product_name, since):
+    rows = await pool.fetch(
+        "SELECT sketch FROM price_sketches WHERE region = $1 AND product_name = $2 AND day >= $3",
+        region,
+        product_name,
+        get_since_day(since),
+    )
+    return merge_price_quantiles(rows)
+
+
+async def get_product_stats(region, product_name):
+    now = datetime.now(config["TIMEZONE"])
+    sinces = [now + period for _, period in STATS_PERIODS]
+
+    stats = await asyncio.gather(*[get_product_stats_since(region, product_name, since) for since in sinces])
+    quantiles = await asyncio.gather(*[get_price_quantiles_since(region, product_name, since) for since in sinces])
+
+    res = []
+    for (label, _), since, r, q in zip(STATS_PERIODS, sinces, stats, quantiles):
+        if r is not None:
+            r["since"] = since
+            r["quantiles"] = q
+            res.append((label, r))
+
+    if res:
+        return dict(res)
+
+
+async def run_handler(handler, handlers):
+    result = None
+    try:
+        while True:
+            name, *args = handler.send(result)
+            result = await handlers[name](*args)
+    except StopIteration:
+        pass
+
+
+async def startup():
+    global pool, client, handlers
+
+    pool = await asyncpg.create_pool(
+        user=config["DB_USER"],
+        password=config["DB_PASSWORD"],
+        host=config["DB_HOST"],
+        database=config["DB_NAME"],
+        min_size=config.get("ASYNC_DB_POOL_MIN", 2),
+        max_size=config.get("ASYNC_DB_POOL_MAX", 20),
+    )
+    client = httpx.AsyncClient(timeout=config.get("VIBER_API_TIMEOUT", 10))
+
+    sender = AsyncViberSender(
+        client,
+        config.get("VIBER_API_URL", "https://chatapi.viber.com/pa"),
+        config["BOT_NAME"],
+        f"{config['WEBHOOK_URL']}/static/avatar.png",
+        config["BOT_AUTH_TOKEN"],
+    )
+    handlers = {
+        "send_messages": sender.send_messages,
+        "get_active_subscriptions": get_active_subscriptions,
+        "unsubscribe": unsubscribe,
+        "subscribe_user": subscribe_user,
+        "get_product_stats": get_product_stats,
+    }
+
+
+async def shutdown():
+    await client.aclose()
+    await pool.close()
+
+
+async def incoming(request):
+    body = await request.body()
+    logger.debug(f"received request. post data: {body}")
+
+    viber_request = viber.parse_request(body.decode("utf8"))
+    await run_handler(handle_viber_request(viber_request), handlers)
+
+    return Response(status_code=200)
+
+
+async def export(request):
+    product_name = request.path_params["product_name"]
+    region = request.path_params["region"]
+
+    dt_since = parse_export_params(product_name, region, request.path_params["since"])
+    if dt_since is None:
+        return PlainTextResponse("Помилка в параметрах", status_code=403)
+
+    if dt_since.tzinfo is None:
+        dt_since = config["TIMEZONE"].localize(dt_since)
+
+    q = await pool.fetch(
+        "SELECT * FROM procurements WHERE product_name = $1 AND region = $2 AND signature_date >= $3::timestamptz "
+        + "ORDER BY signature_date DESC",
+        product_name,
+        region,
+        dt_since,
+    )
+    quantiles = await get_price_quantiles_since(region, product_name, dt_since)
+
+    # rendering of xlsx is cpu bound, so it shouldn't block the event loop
+    content, headers = await asyncio.get_event_loop().run_in_executor(
+        None, build_export_report, q, quantiles, product_name, region
+    )
+    return Response(content, headers=headers)
+
+
+async def start(request):
+    return RedirectResponse(config["VIBER_DEEPLINK"], status_code=302)
+
+
+app = Starlette(
+    debug=config["DEBUG"],
+    routes=[
+        Route("/", incoming, methods=["POST"]),
+        Route("/start", start, methods=["GET"]),
+        Route("/export/{product_name}/{region}/{since}", export, methods=["GET"]),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
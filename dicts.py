@@ -63,6 +63,7 @@ HEADERS = {
 
 
 SUBSCRIPTION_TYPES = {
+    "Одразу після оновлення": "instant",
     "Раз на день": "daily",
     "Раз на тиждень": "weekly",
     "Раз на місяць": "monthly",
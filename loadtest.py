@@ -0,0 +1,106 @@
+"""
+Load test for the webhook with a local stand-in for Viber API.
+
+    python loadtest.py viber --port 8001 --latency 100
+    # set VIBER_API_URL = "http://127.0.0.1:8001" in default_settings and start the bot:
+    #   gunicorn --bind 0.0.0.0:5000 app:app
+    #   gunicorn --bind 0.0.0.0:5000 -k uvicorn.workers.UvicornWorker asgi:app
+    python loadtest.py run http://127.0.0.1:5000/ --requests 2000 --concurrency 100 --text "product_name:Київ:молоко"
+"""
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+import click
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+def get_viber_standin(latency):
+    async def send_message(request):
+        await asyncio.sleep(latency / 1000)
+        return JSONResponse({"status": 0, "status_message": "ok", "message_token": int(time.time() * 1000)})
+
+    return Starlette(routes=[Route("/send_message", send_message, methods=["POST"])])
+
+
+def get_message_request(text):
+    return json.dumps(
+        {
+            "event": "message",
+            "timestamp": int(time.time() * 1000),
+            "message_token": int(time.time() * 1000),
+            "sender": {"id": f"loadtest-{uuid4()}", "name": "loadtest"},
+            "message": {"type": "text", "text": text},
+        }
+    )
+
+
+async def run_load(url, total, concurrency, text):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def worker(client):
+        nonlocal errors
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, content=get_message_request(text))
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError:
+                errors += 1
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=concurrency)) as client:
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "elapsed": elapsed,
+        "rps": len(latencies) / elapsed,
+        "p50": latencies[len(latencies) // 2] if latencies else None,
+        "p95": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--port", default=8001)
+@click.option("--latency", default=100, help="Simulated Viber API latency, ms")
+def viber(port, latency):
+    uvicorn.run(get_viber_standin(latency), host="127.0.0.1", port=port, log_level="warning")
+
+
+@cli.command()
+@click.argument("url")
+@click.option("--requests", "total", default=1000)
+@click.option("--concurrency", default=50)
+@click.option("--text", default="help")
+def run(url, total, concurrency, text):
+    res = asyncio.get_event_loop().run_until_complete(run_load(url, total, concurrency, text))
+
+    click.echo(f"Requests: {res['requests']}, errors: {res['errors']}, elapsed: {res['elapsed']:.2f}s")
+    click.echo(f"Throughput: {res['rps']:.1f} req/s")
+    if res["p50"] is not None:
+        click.echo(f"Latency p50: {res['p50'] * 1000:.0f}ms, p95: {res['p95'] * 1000:.0f}ms, max: {res['max'] * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,65 @@
+import json
+import math
+from collections import Counter
+
+
+class PriceSketch:
+    """
+    Mergeable quantile sketch with log-scale buckets (DDSketch).
+    Quantiles are estimated with relative error of at most relative_accuracy,
+    merging is just adding bucket counts, so sketches of separate days can be combined
+    """
+
+    def __init__(self, buckets=None, zero_count=0, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = Counter(buckets or {})
+        self.zero_count = zero_count
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    def add(self, value):
+        if value is None or value != value:
+            return
+
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            self.buckets[int(math.ceil(math.log(value) / self.log_gamma))] += 1
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.zero_count += other.zero_count
+        return self
+
+    def bucket_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        count = self.count
+        if count == 0:
+            return None
+
+        rank = q * (count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return self.bucket_value(index)
+
+    def quantiles(self, qs):
+        return {q: self.quantile(q) for q in qs}
+
+    def dumps(self):
+        return json.dumps({"zero": self.zero_count, "buckets": {str(k): v for k, v in self.buckets.items()}})
+
+    @classmethod
+    def loads(cls, s):
+        data = json.loads(s)
+        return cls(buckets={int(k): v for k, v in data["buckets"].items()}, zero_count=data["zero"])
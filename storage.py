@@ -1,6 +1,10 @@
 from werkzeug.local import LocalProxy
 import dataset
 import os.path
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy.sql import text
 
 
 _postgres_db = None
@@ -21,3 +25,24 @@ def get_postgres_database(app, schema=None):
 
 
 postgres_db = LocalProxy(get_postgres_database)
+
+# signature dates are stored as timestamps in the session timezone of the database,
+# the day of the contract is its local date in the timezone passed as :tz
+SIGNATURE_DAY_SQL = "(p.signature_date::timestamptz AT TIME ZONE :tz)::date"
+
+
+def mark_synced(meta, timezone):
+    meta.upsert({"key": "last_sync", "value": datetime.now(timezone).isoformat()}, ["key"])
+
+
+@contextmanager
+def schema_lock(db):
+    """
+    Serializes schema changes of commands running at the same time, e.g. the sync and send_instant_alerts,
+    so they don't race on ALTER TABLE of the same column
+    """
+    db.executable.execute(text("SELECT pg_advisory_lock(hashtext('schema'))").execution_options(autocommit=True))
+    try:
+        yield
+    finally:
+        db.executable.execute(text("SELECT pg_advisory_unlock(hashtext('schema'))").execution_options(autocommit=True))